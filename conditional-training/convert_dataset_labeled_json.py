@@ -2,17 +2,24 @@
 # SPDX-License-Identifier: Apache-2.0
 
 """Streaming dataset conversion scripts for json files."""
+import json
+import multiprocessing as mp
 import os
+import tempfile
 from argparse import ArgumentParser, Namespace
 from enum import Enum
-from glob import glob
-from typing import Dict, Iterable, Optional
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import numpy as np
+import pyarrow as pa
+from numba import njit
+from pyarrow import json as pa_json
 
 import datasets as hf_datasets
 from streaming import MDSWriter
-from torch.utils.data import DataLoader, IterableDataset
+from streaming.base.util import merge_index
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 from tqdm import tqdm
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
@@ -33,6 +40,14 @@ def parse_args() -> Namespace:
     parser.add_argument('--path', type=str, required=True)
     parser.add_argument('--out_root', type=str, required=True)
     parser.add_argument('--compression', type=str, default=None)
+    parser.add_argument('--loader',
+                        type=str,
+                        default='arrow',
+                        choices=['arrow', 'orjson'])
+    parser.add_argument('--output_format',
+                        type=str,
+                        default='mds',
+                        choices=['mds', 'arrow'])
 
     group = parser.add_mutually_exclusive_group(required=False)
     group.add_argument(
@@ -45,6 +60,9 @@ def parse_args() -> Namespace:
     parser.add_argument('--bos_text', type=str, required=False, default=None)
     parser.add_argument('--eos_text', type=str, required=False, default=None)
     parser.add_argument('--no_wrap', default=False, action='store_true')
+    parser.add_argument('--num_workers', type=int, required=False, default=1) # processes converting disjoint subsets of input files
+    parser.add_argument('--loader_workers', type=int, required=False, default=0) # dataloader processes tokenizing for every writer
+    parser.add_argument('--cache_dir', type=str, required=False, default=None) # where parsed input is spilled to disk, defaults to the system temp dir
 
     # add Cond. Training specific args here
     parser.add_argument("--num-sentinels", type=int, required=False, default=None)
@@ -64,6 +82,8 @@ def parse_args() -> Namespace:
             isinstance(parsed.concat_tokens, int) and parsed.tokenizer is None):
         parser.error(
             'When setting --concat_tokens, you must specify a --tokenizer')
+    if parsed.output_format == 'arrow' and parsed.concat_tokens is None:
+        parser.error('--output_format=arrow requires --concat_tokens')
 
     # now that we have validated them, change BOS/EOS to strings
     if parsed.bos_text is None:
@@ -73,46 +93,244 @@ def parse_args() -> Namespace:
     return parsed
 
 
+def _token_dtype(tokenizer: PreTrainedTokenizerBase) -> np.dtype:
+    """Smallest dtype every token id of `tokenizer`, sentinels included, fits in."""
+    # gpt-neox's ~50k vocab (plus sentinels) fits in 16 bits, halving the output size
+    if len(tokenizer) <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+
+def _write_tokens_metadata(out_root: str, dtype: np.dtype) -> None:
+    """Records the dtype of the MDS `tokens` column once, in `{out_root}/metadata.json`."""
+    with open(os.path.join(out_root, 'metadata.json'), 'w') as f:
+        json.dump({'tokens_dtype': np.dtype(dtype).name}, f)
+
+
+@njit(cache=True)
+def _pack_sentences(ids: np.ndarray, lens: np.ndarray, labels: np.ndarray,
+                    use_label: np.ndarray, bos: np.ndarray, eos: np.ndarray,
+                    out: np.ndarray, pos: int) -> int:
+    """Writes `bos + [label] + ids + eos` of every sentence into `out`, starting at `pos`.
+
+    Args:
+        ids (np.ndarray): Token ids of all sentences, concatenated
+        lens (np.ndarray): Number of tokens of every sentence
+        labels (np.ndarray): Sentinel token id of every sentence
+        use_label (np.ndarray): Whether to prepend the sentinel token to every sentence
+        bos (np.ndarray): Tokens inserted before every sentence
+        eos (np.ndarray): Tokens inserted after every sentence
+        out (np.ndarray): Token buffer, large enough to fit every sentence
+        pos (int): Position in `out` to start writing at
+
+    Returns:
+        (int) Position in `out` after the last written token
+    """
+    offset = 0
+    for i in range(lens.shape[0]):
+        for token in bos:
+            out[pos] = token
+            pos += 1
+        if use_label[i]:
+            out[pos] = labels[i]
+            pos += 1
+        for j in range(offset, offset + lens[i]):
+            out[pos] = ids[j]
+            pos += 1
+        offset += lens[i]
+        for token in eos:
+            out[pos] = token
+            pos += 1
+    return pos
+
+
 class ConcatLabeledTokensDataset(ConcatTokensDataset):
     # subclass of ConcatTokens dataset.
 
     def __init__(self, *args, **kwargs):
 
-        assert "score_to_label" in kwargs and callable(kwargs["score_to_label"])
+        assert "label_ids" in kwargs and len(kwargs["label_ids"]) >= 2
+        assert "score_cutoff" in kwargs
         assert "label_prob" in kwargs
 
-        self.score_to_label = kwargs.pop("score_to_label")
+        # sentences scoring below the cutoff get label_ids[1], the rest label_ids[0]
+        self.label_ids = np.asarray(kwargs.pop("label_ids"), dtype=np.int32)
+        self.score_cutoff = kwargs.pop("score_cutoff")
         self.label_prob = kwargs.pop("label_prob")
+        self.rng = np.random.default_rng()
 
         super().__init__(*args, **kwargs)
 
+        # typed copies of the parent's bos / eos token lists, for the packing kernel
+        self._bos = np.asarray(self.bos_tokens, dtype=np.int32)
+        self._eos = np.asarray(self.eos_tokens, dtype=np.int32)
+
+        self.token_dtype = _token_dtype(self.tokenizer)
+        assert self.label_ids.max() <= np.iinfo(self.token_dtype).max
+
+    def _iter_batches(self) -> Iterable[Tuple[List[str], np.ndarray, np.ndarray]]:
+        """Yields the sentences of every arrow record batch, flattened over its documents.
+
+        The `sentences` and `scores` list columns of a batch are flattened into one list
+        of sentences and one array of scores, document `i` spanning
+        `offsets[i]:offsets[i + 1]`. When iterated by a dataloader worker, only the
+        worker's contiguous shard of the table is read, so every worker flushes its own
+        samples and may drop a shorter than `max_length` tail at the end of its shard.
+
+        Yields:
+            (sentences, scores, offsets) of every record batch
+        """
+        table = self.hf_dataset.data.table
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            # zero-copy slice, same split as hf `Dataset.shard(..., contiguous=True)`
+            rows_per_worker, extra = divmod(table.num_rows, worker_info.num_workers)
+            start = worker_info.id * rows_per_worker + min(worker_info.id, extra)
+            table = table.slice(start, rows_per_worker + int(worker_info.id < extra))
+
+        for batch in table.to_batches(max_chunksize=1024):
+            sentences = batch.column('sentences')
+            scores = batch.column('scores')
+            offsets = sentences.offsets.to_numpy()
+            offsets = offsets - offsets[0]
+            score_offsets = scores.offsets.to_numpy()
+            assert np.array_equal(offsets, score_offsets - score_offsets[0])
+            yield (sentences.flatten().to_pylist(),
+                   scores.flatten().to_numpy(zero_copy_only=False), offsets)
+
     def __iter__(self) -> Iterable[Dict[str, bytes]]:
 
-        buffer = []
-        for sample in self.hf_dataset:
-            assert len(sample['sentences']) == len(sample['scores'])
-            for sent, score in zip(sample['sentences'], sample['scores']):
-                encoded = self.tokenizer(sent,
-                                        truncation=False,
-                                        padding=False)
-                label_token = self.score_to_label(score)
-
-                if np.random.uniform() < self.label_prob:
-                    iids = [label_token] + encoded['input_ids']
-                else:
-                    iids = encoded['input_ids']
-                buffer = buffer + self.bos_tokens + iids + self.eos_tokens
-            while len(buffer) >= self.max_length:
-                concat_sample = buffer[:self.max_length]
-                buffer = buffer[self.max_length:] if self.should_wrap else []
-                yield {
-                    # convert to bytes to store in MDS binary format
-                    'tokens': np.asarray(concat_sample).tobytes()
-                }
+        # forked dataloader workers share self.rng's state, give each its own stream
+        worker_info = get_worker_info()
+        rng = self.rng if worker_info is None else np.random.default_rng(worker_info.seed)
+
+        # the rust tokenizer behind the fast tokenizer, only returns the ids we need
+        encode_batch = self.tokenizer.backend_tokenizer.encode_batch
+
+        # rolling token buffer, grown only if a record batch overflows it
+        buffer = np.empty(2 * self.max_length, dtype=self.token_dtype)
+        n_tokens = 0
+        for sentences, scores, offsets in self._iter_batches():
+            if len(sentences) == 0:
+                continue
+            # tokenize all sentences of the record batch in a single (fast) tokenizer call
+            encoded = [
+                encoding.ids
+                for encoding in encode_batch(sentences, add_special_tokens=False)
+            ]
+            # draw whether to prepend a label for every sentence at once
+            use_label = rng.random(len(encoded)) < self.label_prob
+            labels = self.label_ids[(scores < self.score_cutoff).astype(np.intp)]
+            lens = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+            ids = np.fromiter(chain.from_iterable(encoded), dtype=np.int32, count=lens.sum())
+
+            # buffer position after every sentence, and after every document
+            sentence_ends = np.cumsum(lens + use_label + self._bos.size + self._eos.size)
+            sentence_ends = np.concatenate(([0], sentence_ends)) + n_tokens
+            if sentence_ends[-1] > len(buffer):
+                grown = np.empty(max(2 * len(buffer), sentence_ends[-1]), dtype=buffer.dtype)
+                grown[:n_tokens] = buffer[:n_tokens]
+                buffer = grown
+            n_tokens = _pack_sentences(ids, lens, labels, use_label, self._bos,
+                                       self._eos, buffer, n_tokens)
+
+            # emit samples straight out of the buffer, then move the leftover tokens
+            # to its front once per record batch instead of once per sample. without
+            # wrapping, the leftover of a document that filled a sample is dropped.
+            doc_ends = [n_tokens] if self.should_wrap else sentence_ends[offsets[1:]].tolist()
+            start = 0
+            for doc_end in doc_ends:
+                while doc_end - start >= self.max_length:
+                    yield {
+                        # the one copy per sample: MDS `bytes` columns (and dataloader
+                        # workers pickling samples) need an owned bytes object
+                        'tokens': buffer[start:start + self.max_length].tobytes(),
+                    }
+                    start = start + self.max_length if self.should_wrap else doc_end
+            if start > 0:
+                n_tokens -= start
+                buffer[:n_tokens] = buffer[start:start + n_tokens]
+
+
+def list_data_files(path: str) -> List[str]:
+    """Returns the jsonl files under `path` sorted by name, or `[path]` if it is a single file."""
+    if os.path.isdir(path):
+        # a single directory read, sorted so files are read (and sharded) in a stable order
+        with os.scandir(path) as entries:
+            return sorted(entry.path
+                          for entry in entries
+                          if entry.is_file() and not entry.name.startswith('.'))
+    return [path]
+
+
+def _json_schema(mode: ConcatMode) -> pa.Schema:
+    """The columns read from the jsonl files in `mode`, all other fields are dropped while parsing."""
+    if mode == ConcatMode.NO_CONCAT:
+        return pa.schema([('text', pa.string())])
+    return pa.schema([('sentences', pa.list_(pa.string())),
+                      ('scores', pa.list_(pa.float64()))])
+
+
+def _iter_json_batches(data_files: List[str],
+                       schema: pa.Schema) -> Iterable[pa.RecordBatch]:
+    """Streams record batches of the `schema` columns out of every file with pyarrow.json."""
+    # multi-threaded parsing of 64MB blocks, straight into arrow
+    read_options = pa_json.ReadOptions(use_threads=True, block_size=64 << 20)
+    parse_options = pa_json.ParseOptions(explicit_schema=schema,
+                                         unexpected_field_behavior='ignore')
+    for data_file in data_files:
+        with pa_json.open_json(data_file,
+                               read_options=read_options,
+                               parse_options=parse_options) as reader:
+            yield from reader
+
+
+def _iter_jsonl(data_files: List[str],
+                schema: pa.Schema,
+                batch_size: int = 1024) -> Iterable[pa.RecordBatch]:
+    """Parses every file line by line with orjson, yielding record batches of the `schema` columns."""
+    import orjson
+
+    names = schema.names
+    rows: List[Dict[str, Any]] = []
+    for data_file in data_files:
+        with open(data_file, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                # only the columns we read outlive the parsed record
+                record = orjson.loads(line)
+                rows.append({name: record.get(name) for name in names})
+                if len(rows) == batch_size:
+                    yield pa.RecordBatch.from_pylist(rows, schema=schema)
+                    rows = []
+    if len(rows) > 0:
+        yield pa.RecordBatch.from_pylist(rows, schema=schema)
+
+
+def _memory_mapped_table(batches: Iterable[pa.RecordBatch], schema: pa.Schema,
+                         cache_dir: Optional[str]) -> pa.Table:
+    """Writes `batches` to an arrow file in `cache_dir` and returns it as a memory mapped table.
+
+    Only one record batch is held in memory while writing, so the parsed corpus lives in
+    the page cache instead of the process heap, like the arrow cache of HF's json builder.
+    The file is unlinked as soon as it is mapped, so its space is freed once the table
+    (and the mappings inherited by forked workers) are gone.
+    """
+    fd, cache_file = tempfile.mkstemp(suffix='.arrow', dir=cache_dir)
+    os.close(fd)
+    try:
+        with pa.OSFile(cache_file, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for batch in batches:
+                    writer.write_batch(batch)
+        return pa.ipc.open_file(pa.memory_map(cache_file)).read_all()
+    finally:
+        os.remove(cache_file)
 
 
 def build_hf_dataset(
-    path: str,
+    path: Union[str, List[str]],
     split: str,
     mode: ConcatMode,
     max_length: Optional[int] = None,
@@ -120,13 +338,16 @@ def build_hf_dataset(
     eos_text: str = '',
     no_wrap: bool = False,
     tokenizer: PreTrainedTokenizerBase = None,
-    score_to_label: callable = None,
+    label_ids: Optional[List[int]] = None,
+    score_cutoff: float = None,
     label_prob: float = None,
+    loader: str = 'arrow',
+    cache_dir: Optional[str] = None,
 ) -> IterableDataset:
     """Build an IterableDataset over the HF C4 or pile source data.
 
     Args:
-        dataset_name (str): Dataset name
+        path (Union[str, List[str]]): A jsonl file, a directory of them, or a list of files
         split (str): Split name.
         mode (ConcatMode): NO_CONCAT, or CONCAT_TOKENS
         max_length (int): The length of concatenated tokens
@@ -134,20 +355,25 @@ def build_hf_dataset(
         eos_text (str): text to insert at the end of each sequence
         no_wrap (bool): if concatenating, whether to wrap text across `max_length` boundaries
         tokenizer (PreTrainedTokenizerBase): if mode is CONCAT_TOKENS, the tokenizer to use
+        loader (str): `arrow` to parse files with pyarrow.json, `orjson` to parse them line by line.
+            Either way only the columns the dataset reads are kept.
+        cache_dir (Optional[str]): Directory of the memory mapped arrow file of the parsed input
         data_subset (str): Referred to as "name" in HuggingFace datasets.load_dataset.
             Typically "all" (The Pile) or "en" (c4).
 
     Returns:
         An IterableDataset.
     """
-    if os.path.isdir(path):
-        data_files = glob(f'{path}/*')
-    else:
-        data_files = path
+    data_files = path if isinstance(path, list) else list_data_files(path)
 
-    hf_dataset = hf_datasets.load_dataset('json',
-                                          data_files=data_files,
-                                          split=split)
+    # the explicit schema also keeps files whose inferred types would differ compatible
+    schema = _json_schema(mode)
+    if loader == 'orjson':
+        batches = _iter_jsonl(data_files, schema)
+    else:
+        batches = _iter_json_batches(data_files, schema)
+    table = _memory_mapped_table(batches, schema, cache_dir)
+    hf_dataset = hf_datasets.Dataset(table)
 
     if mode == ConcatMode.NO_CONCAT:
         dataset = NoConcatDataset(hf_dataset)
@@ -155,6 +381,8 @@ def build_hf_dataset(
         if not isinstance(tokenizer, PreTrainedTokenizerBase):
             raise ValueError(
                 f'{tokenizer=} must be of type PreTrainedTokenizerBase')
+        if not tokenizer.is_fast:
+            raise ValueError(f'{tokenizer=} must be a fast (rust backed) tokenizer')
         if max_length is None:
             raise ValueError(f'max_length must be set.')
         if bos_text + eos_text == '':
@@ -174,7 +402,8 @@ def build_hf_dataset(
                                       bos_text=bos_text,
                                       eos_text=eos_text,
                                       no_wrap=no_wrap,
-                                      score_to_label=score_to_label,
+                                      label_ids=label_ids,
+                                      score_cutoff=score_cutoff,
                                       label_prob=label_prob)
     return dataset
 
@@ -194,13 +423,160 @@ def generate_samples(
     """
     n_samples = 0
     for batch in loader:
-        keys = list(batch.keys())
-        current_bs = len(batch[keys[0]])
-        for idx in range(current_bs):
-            if truncate_num_samples is not None and n_samples == truncate_num_samples:
-                return
-            n_samples += 1
-            yield {k: v[idx] for k, v in batch.items()}
+        items = list(batch.items())
+        current_bs = len(items[0][1])
+        if truncate_num_samples is not None:
+            current_bs = min(current_bs, truncate_num_samples - n_samples)
+        if len(items) == 1:
+            # single column, e.g. concat mode's `tokens`: skip rebuilding the dict per sample
+            key, values = items[0]
+            for value in values[:current_bs]:
+                yield {key: value}
+        else:
+            for idx in range(current_bs):
+                yield {k: v[idx] for k, v in items}
+        n_samples += current_bs
+        if truncate_num_samples is not None and n_samples == truncate_num_samples:
+            return
+
+
+class ArrowTokensWriter:
+    """Writes concatenated token samples to an Arrow IPC (Feather v2) file.
+
+    Samples are buffered into a 2D array and written as record batches of a single
+    `FixedSizeList<tokens, max_length>` column, so readers can memory map the file
+    without any per-sample deserialization. Exposes the same `write` / context
+    manager interface as `MDSWriter`.
+
+    Args:
+        out (str): Output directory, the file is written to `{out}/tokens.arrow`
+        max_length (int): Number of tokens in every sample
+        dtype (np.dtype): Dtype the sample bytes were serialized with
+        compression (Optional[str]): Arrow IPC buffer compression (`lz4` or `zstd`)
+        batch_bytes (int): Approximate size of every record batch written
+    """
+
+    def __init__(self,
+                 out: str,
+                 max_length: int,
+                 dtype: np.dtype = np.int32,
+                 compression: Optional[str] = None,
+                 batch_bytes: int = 64 << 20):
+        os.makedirs(out, exist_ok=True)
+        self.path = os.path.join(out, 'tokens.arrow')
+        self.max_length = max_length
+        self.dtype = np.dtype(dtype)
+        self.schema = pa.schema([
+            pa.field('tokens',
+                     pa.list_(pa.from_numpy_dtype(self.dtype), max_length))
+        ])
+        self.options = pa.ipc.IpcWriteOptions(compression=compression)
+
+        batch_rows = max(1, batch_bytes // (max_length * self.dtype.itemsize))
+        self._rows = np.empty((batch_rows, max_length), dtype=self.dtype)
+        self._n_rows = 0
+        self._writer = None
+
+    def __enter__(self) -> 'ArrowTokensWriter':
+        self._writer = pa.ipc.new_file(self.path, self.schema, options=self.options)
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._flush()
+        self._writer.close()
+
+    def write(self, sample: Dict[str, bytes]) -> None:
+        self._rows[self._n_rows] = np.frombuffer(sample['tokens'], dtype=self.dtype)
+        self._n_rows += 1
+        if self._n_rows == len(self._rows):
+            self._flush()
+
+    def _flush(self) -> None:
+        if self._n_rows == 0:
+            return
+        tokens = pa.FixedSizeListArray.from_arrays(
+            pa.array(self._rows[:self._n_rows].ravel()), self.max_length)
+        self._writer.write_batch(pa.record_batch([tokens], schema=self.schema))
+        self._n_rows = 0
+
+
+def convert(args: Namespace,
+            data_files: List[str],
+            out_root: str,
+            mode: ConcatMode,
+            tokenizer: Optional[PreTrainedTokenizerBase],
+            columns: Dict[str, str],
+            label_ids: Optional[List[int]],
+            score_cutoff: float,
+            position: int = 0) -> None:
+    """Tokenizes `data_files` and writes the samples to `out_root`.
+
+    Args:
+        args (Namespace): Commandline arguments.
+        data_files (List[str]): Jsonl files to convert
+        out_root (str): Directory to write the MDS shards / arrow file to
+        mode (ConcatMode): NO_CONCAT, or CONCAT_TOKENS
+        tokenizer (Optional[PreTrainedTokenizerBase]): Tokenizer with sentinel tokens added
+        columns (Dict[str, str]): MDS column encodings
+        label_ids (Optional[List[int]]): Sentinel token ids of the score buckets
+        score_cutoff (float): Sentences scoring below this get the second sentinel token
+        position (int): Position of this conversion's progress bar
+    """
+    dataset = build_hf_dataset(path=data_files,
+                               split=args.split,
+                               mode=mode,
+                               max_length=args.concat_tokens,
+                               bos_text=args.bos_text,
+                               eos_text=args.eos_text,
+                               no_wrap=args.no_wrap,
+                               tokenizer=tokenizer,
+                               label_ids=label_ids,
+                               score_cutoff=score_cutoff,
+                               label_prob=args.label_prob,
+                               loader=args.loader,
+                               cache_dir=args.cache_dir)
+
+    if args.output_format == 'arrow':
+        writer = ArrowTokensWriter(out=out_root,
+                                   max_length=args.concat_tokens,
+                                   dtype=dataset.token_dtype,
+                                   compression=args.compression)
+    else:
+        writer = MDSWriter(columns=columns,
+                           out=out_root,
+                           compression=args.compression)
+    # tokenize in dataloader workers while this process writes
+    loader = DataLoader(dataset,
+                        batch_size=512,
+                        num_workers=args.loader_workers,
+                        **({'prefetch_factor': 4} if args.loader_workers > 0 else {}))
+    with writer as out:
+        # bound once, MDSWriter has no multi-sample write to batch samples into
+        write = out.write
+        # refresh the bar at most once a second, checking the clock every 1000 samples
+        for sample in tqdm(generate_samples(loader),
+                           position=position,
+                           mininterval=1.0,
+                           miniters=1000,
+                           smoothing=0.0):
+            write(sample)
+    if mode == ConcatMode.CONCAT_TOKENS and args.output_format == 'mds':
+        # written after the MDSWriter, which expects an empty output directory
+        _write_tokens_metadata(out_root, dataset.token_dtype)
+
+
+# Arguments of `convert` shared with forked shard workers. Set by `main` before the
+# workers are forked, so the tokenizer is inherited copy-on-write instead of pickled.
+_shard_state: Dict[str, Any] = {}
+
+
+def _convert_shard(shard_id: int, data_files: List[str]) -> None:
+    """Shard worker: converts one subset of input files into `{out_root}/shard-{shard_id}`."""
+    out_root = os.path.join(_shard_state['args'].out_root, f'shard-{shard_id}')
+    convert(data_files=data_files,
+            out_root=out_root,
+            position=shard_id,
+            **_shard_state)
 
 
 def main(args: Namespace) -> None:
@@ -213,9 +589,15 @@ def main(args: Namespace) -> None:
 
     if args.concat_tokens is not None:
         mode = ConcatMode.CONCAT_TOKENS
-        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        # let the rust tokenizers backend use all cores for batched encoding,
+        # unless there already are multiple processes tokenizing
+        single_process = args.num_workers <= 1 and args.loader_workers == 0
+        os.environ.setdefault('TOKENIZERS_PARALLELISM',
+                              'true' if single_process else 'false')
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=True)
         # we will enforce length, so suppress warnings about sequences too long for the model
         tokenizer.model_max_length = int(1e30)
+        # the tokens' dtype is recorded once in metadata.json, not per sample
         columns = {'tokens': 'bytes'}
     else:
         mode = ConcatMode.NO_CONCAT
@@ -233,41 +615,52 @@ def main(args: Namespace) -> None:
 
     tokenizer.save_pretrained(f"./{args.tokenizer.replace('/', '_')}-{args.num_sentinels}-special-tokens")
 
-    # define score_to_label fn
-    def score_to_label(score: float) -> int:
-        def score_to_bucket(score: float) -> int:
-            # simple bucketing -- bucket scores greater than cutoff into bucket1, lower into bucket0
-            if score < 5.6e-4:
-                return 1 # this means that toxic data is in the val0 bucket
-            else:
-                return 0
-        bucket = score_to_bucket(score)
+    # simple bucketing -- sentences scoring below the cutoff get the val1 token, the rest
+    # val0. this means that toxic data is in the val0 bucket
+    label_ids = tokenizer.additional_special_tokens_ids
+    score_cutoff = 5.6e-4
 
-        return tokenizer.additional_special_tokens[bucket]
-
-    # Get samples
-    dataset = build_hf_dataset(path=args.path,
-                               split=args.split,
-                               mode=mode,
-                               max_length=args.concat_tokens,
-                               bos_text=args.bos_text,
-                               eos_text=args.eos_text,
-                               no_wrap=args.no_wrap,
-                               tokenizer=tokenizer,
-                               score_to_label=score_to_label,
-                               label_prob=args.label_prob)
+    convert_kwargs = dict(args=args,
+                          mode=mode,
+                          tokenizer=tokenizer,
+                          columns=columns,
+                          label_ids=label_ids,
+                          score_cutoff=score_cutoff)
+    data_files = list_data_files(args.path)
 
     # Write samples
-    print(f'Converting to MDS format...')
+    print(f'Converting to {args.output_format.upper()} format...')
     print(
         f'Note that the progress bar is based on the dataset length before tokenization.'
     )
     print(f'It will finish at a value below 100% if tokenizing')
-    with MDSWriter(columns=columns,
-                   out=os.path.join(args.out_root),
-                   compression=args.compression) as out:
-        for sample in tqdm(dataset):
-            out.write(sample)
+    if args.num_workers <= 1:
+        convert(data_files=data_files, out_root=args.out_root, **convert_kwargs)
+        return
+
+    # every worker converts a disjoint subset of files into its own sub directory.
+    # plain (non daemonic) processes are used, so workers can start dataloader workers.
+    shards = [data_files[i::args.num_workers] for i in range(args.num_workers)]
+    shards = [shard for shard in shards if len(shard) > 0]
+    _shard_state.update(convert_kwargs)
+    ctx = mp.get_context('fork')
+    workers = [
+        ctx.Process(target=_convert_shard, args=(shard_id, shard))
+        for shard_id, shard in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [shard_id for shard_id, worker in enumerate(workers) if worker.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f'Conversion of shards {failed} failed')
+
+    if args.output_format == 'mds':
+        # combine the shard-* index files into a single top level index.json
+        merge_index(args.out_root, keep_local=True)
+        if mode == ConcatMode.CONCAT_TOKENS:
+            _write_tokens_metadata(args.out_root, _token_dtype(tokenizer))
 
 
 if __name__ == '__main__':
@@ -4,38 +4,102 @@ import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "utils", "gpt-neox"))
 sys.path.append(os.path.join(os.path.dirname(__file__), "..", "utils"))
-from mmap_dataset import MMapIndexedDataset
+from mmap_dataset import MMapIndexedDataset, index_file_path, data_file_path
+import contextlib
+import fcntl
+import gzip
+import hashlib
+import io
+import shutil
 import logging
 import time
-import datetime
 import torch
-import copy
 import boto3
 import numpy as np
-import torch.distributed as dist
-from torch.utils.data import Dataset, DataLoader
-from transformers import GPTNeoXForCausalLM
+from collections import deque
+from transformers import GPTNeoXForCausalLM, StaticCache
 import transformers.utils as transformer_utils
 import multiprocessing as mp
-import time
-from tqdm import trange
+
+@contextlib.contextmanager
+def cache_index_in_shm(prefix, shm_dir = '/dev/shm'):
+    """Copies the index file of a pile dataset into shared memory, once per node
+
+    All ranks of a node then mmap the same in-memory copy of the `.idx`, instead of each
+    of them reading it from the network filesystem. The `.bin` is only symlinked next to
+    it. A node local lock file makes sure only the first process copies, the other ones
+    wait for it and reuse the copy. The copy is keyed on the path, size and mtime of the
+    `.idx`, so an index regenerated in place is copied again.
+
+    Every process holds a shared lock on the copy while using it. On exit, the last one
+    to leave removes the copy. A copy left behind by a killed process is removed by the
+    last user of the next job using it.
+
+    Args:
+        prefix (str): Path of the dataset, with or without `.bin` suffix
+        shm_dir (str): Shared memory directory to copy the index into
+
+    Yields:
+        prefix of the dataset in `shm_dir`
+    """
+    if prefix.endswith(".bin"):
+        prefix = prefix[:-4]
+    prefix = os.path.abspath(prefix)
+    stat = os.stat(index_file_path(prefix))
+    key = f'{prefix}:{stat.st_size}:{stat.st_mtime_ns}'
+    shm_path = os.path.join(shm_dir, 'pile_idx_' + hashlib.md5(key.encode()).hexdigest())
+    shm_prefix = os.path.join(shm_path, os.path.basename(prefix))
+    node_lock = os.path.join(shm_dir, 'pile_idx.lock')
+
+    with open(node_lock, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(index_file_path(shm_prefix)):
+            os.makedirs(shm_path, exist_ok = True)
+            if not os.path.lexists(data_file_path(shm_prefix)):
+                os.symlink(data_file_path(prefix), data_file_path(shm_prefix))
+            # Copy under a temporary name, so an interrupted copy is never used
+            shutil.copyfile(index_file_path(prefix), index_file_path(shm_prefix) + '.tmp')
+            os.replace(index_file_path(shm_prefix) + '.tmp', index_file_path(shm_prefix))
+        users = open(os.path.join(shm_path, 'users.lock'), 'w')
+        fcntl.flock(users, fcntl.LOCK_SH)
+
+    try:
+        yield shm_prefix
+    finally:
+        with open(node_lock, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fcntl.flock(users, fcntl.LOCK_UN)
+            try:
+                # Only succeeds if no other process still holds its shared lock
+                fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(shm_path)
+            except BlockingIOError:
+                pass
+            users.close()
 
 def generate_dataset(batch_size, start_seq_idx, end_seq_idx, mp_queue, 
-    using_s3 = False, 
-    prefetch_max = 128
+    token_slots, free_slots, producer = 0,
+    using_s3 = False
 ):
     """Wrapper function to prefetch pile sequences
 
     Intended to run in a saperate `multiprocessing.Process`, this function will continuously prefetch
-    context tokens and true continuation from s3 and adds them to `mp_queue`
+    the first 64 tokens of sequences (32 context tokens followed by 32 true continuation
+    tokens) from s3 into shared memory slots, with one copy per batch. Only
+    `(start index of batch, producer, slot, number of sequences)` is added to `mp_queue`,
+    so batches are never pickled. Slots are used round robin, and a slot is only refilled
+    after the consumer released it through `free_slots`. Once done, `(None, producer, None, None)`
+    is added to `mp_queue`
 
     Args:
         batch_size (int): Batch size of sequences being evaluted
-        start_seq_idx (int): Sequence index of first sequence to be evaluated by current rank
-        end_seq_idx (int): Sequence index of last sequence to be evalauted by current rank
-        mp_queue (multiprocessing.Queue): Instance of multiprocessing Queue, to add sequences into
+        start_seq_idx (int): Sequence index of first sequence to be prefetched by this producer
+        end_seq_idx (int): Sequence index of last sequence to be prefetched by this producer
+        mp_queue (multiprocessing.Queue): Instance of multiprocessing Queue, to add filled slots into
+        token_slots (torch.Tensor): This producer's shared memory tensor of shape (num_slots, batch_size, 64)
+        free_slots (multiprocessing.Semaphore): Counts this producer's slots that can be filled
+        producer (int): Index of this producer, added to every item of `mp_queue`
         using_s3 (bool): If your datasets are located in s3, set this to true
-        prefetch_max (int): Maximum number of sequences that can be pre-fetched into the queue
     
     Env Vars:
         MODEL: name of pythia model being evaluated
@@ -48,71 +112,264 @@ def generate_dataset(batch_size, start_seq_idx, end_seq_idx, mp_queue,
         prefix = 'orz/pile/deduped/document.bin'
     s3 = boto3.client('s3')
     buff_size = 2049*batch_size*2
-    if using_s3 == False:
-        mmap_ds = MMapIndexedDataset(prefix, skip_warmup=True)
-
-    # Iterate over pile and add sequences to mp_queue
-    context_tokens = []
-    true_continuation = []
-    i = 0
-    for i in range(start_seq_idx, end_seq_idx + 1, batch_size):
-        if using_s3:
-            dataset = s3.get_object(
-                Bucket = os.environ['BUCKET'], 
-                Key = prefix,
-                Range = f'bytes={i*2049*2}-{i*2049*2 + buff_size}'
-            )
-            data = dataset['Body'].read(buff_size)
-            data = np.frombuffer(data, dtype = np.uint16).reshape(-1, 2049)
-        else:
-            data = mmap_ds[i:i+batch_size]
-        context_tokens.extend(data[:, :32].tolist())
-        true_continuation.extend(data[:,32:64].tolist())
-        i += len(context_tokens)
-
-        if len(context_tokens) == batch_size:
-            # (start index of batch, context tokens, true continuation)
-            mp_queue.put((
-                i - len(context_tokens), 
-                context_tokens, true_continuation))
-            context_tokens = []
-            true_continuation = []
-            while mp_queue.qsize() > prefetch_max:
-                time.sleep(0.05)
-
-    if len(context_tokens) > 0:
-        mp_queue.put((i - len(context_tokens) + 1, context_tokens, true_continuation))
-        context_tokens = []
-        true_continuation = []
-    
-    mp_queue.put((None, None, None))
+    with contextlib.ExitStack() as stack:
+        if using_s3 == False:
+            shm_prefix = stack.enter_context(cache_index_in_shm(prefix))
+            mmap_ds = MMapIndexedDataset(shm_prefix, skip_warmup=True)
+
+        # Iterate over pile and add sequences to mp_queue
+        token_slots = token_slots.numpy()
+        slot = 0
+        for i in range(start_seq_idx, end_seq_idx + 1, batch_size):
+            # The last batch stops at end_seq_idx instead of reading into the next rank's range
+            num_sequences = min(batch_size, end_seq_idx + 1 - i)
+            if using_s3:
+                dataset = s3.get_object(
+                    Bucket = os.environ['BUCKET'], 
+                    Key = prefix,
+                    Range = f'bytes={i*2049*2}-{i*2049*2 + buff_size}'
+                )
+                data = dataset['Body'].read(buff_size)
+                data = np.frombuffer(data, dtype = np.uint16).reshape(-1, 2049)[:num_sequences]
+            else:
+                data = mmap_ds[i:i+num_sequences]
+
+            # Block until the consumer has released the next slot
+            free_slots.acquire()
+            token_slots[slot, :len(data)] = data[:, :64]
+            mp_queue.put((i, producer, slot, len(data)))
+            slot = (slot + 1) % len(token_slots)
+
+    mp_queue.put((None, producer, None, None))
     
     
 
 
+def fetch_batch(mp_queue, token_slots, free_slots, copy_stream, staging):
+    """Gets the next batch filled by `generate_dataset` and starts copying it to the gpu
 
-def score(model, context_tokens, true_continuation):
+    Batches are staged in preallocated pinned buffers, used round robin, and copied
+    asynchronously on `copy_stream`, so the copy overlaps with scoring of the previous
+    batch. The compute stream has to wait on `copy_stream` before using the returned
+    tensors. Context tokens and true continuation are copied together and returned as
+    views of the same gpu tensor.
+
+    Args:
+        mp_queue (multiprocessing.Queue): Queue of filled slots, shared by all producers
+        token_slots (torch.Tensor): Shared memory slots of context tokens and true continuation,
+            of shape (num_producers, num_slots, batch_size, 64)
+        free_slots (list): Semaphore of every producer, released once the batch's slot can be refilled
+        copy_stream (torch.cuda.Stream): Stream to copy the batch to the gpu on
+        staging (collections.deque): `(pinned buffer of shape (batch_size, 64), cuda event)`
+            pairs, the event marks the end of the last copy out of the buffer
+
+    Returns:
+        (start index of batch, context tokens, true continuation), all `None` once
+        a producer is done
+    """
+    idx, producer, slot, num_sequences = mp_queue.get()
+    if idx is None:
+        return None, None, None
+
+    buffer, copied = staging[0]
+    staging.rotate(-1)
+    # The buffer can only be overwritten once its previous copy to the gpu is done
+    copied.synchronize()
+    tokens = buffer[:num_sequences]
+    tokens.copy_(token_slots[producer, slot, :num_sequences])
+    # The slot was copied to the staging buffer, so it can already be refilled
+    free_slots[producer].release()
+
+    with torch.cuda.stream(copy_stream):
+        tokens = tokens.to('cuda', non_blocking = True)
+        copied.record()
+    return idx, tokens[:, :32], tokens[:, 32:]
+
+def score(model, context_tokens, true_continuation, decode_step = None, cache = None):
     """Calculate memorization score from context tokens and true continuation
 
-    Performs greedy generation from context tokens and calculates memorization score
+    Performs greedy generation from context tokens and counts the generated tokens that
+    match the true continuation.
+    The context is run through the model once to fill the kv cache, after which every
+    generated token only needs a single token forward pass.
+
+    If `decode_step` and `cache` are given, batches are decoded with the compiled
+    `decode_step` into the preallocated static `cache`. Smaller batches (i.e. the last
+    partial batch of a rank) are padded to the cache's batch size, so every decode
+    step replays the same cuda graph. Without `cache`, decoding runs eagerly with a
+    dynamic cache.
 
     Args:
         model (transformers.GPTNeoXForCausalLM): Pythia model instance being evaluated
-        context_tokens (torch.Tensor): Context token indicies of shape (batch_size, 32)
-        true_continuation (torch.Tensor): True continuation indicies of shape (batch_size, 32)
+        context_tokens (torch.Tensor): Cuda context token indicies of shape (batch_size, 32)
+        true_continuation (torch.Tensor): Cuda true continuation indicies of shape (batch_size, 32)
+        decode_step (Callable): Compiled `model`, used for single token forward passes
+        cache (transformers.StaticCache): Static kv cache with room for a full batch
+            of `BATCH_SIZE` sequences
 
     Returns:
-        accuracies (torch.Tensor): Accuracies of shape (batch_size,)
+        num_correct (torch.Tensor): Cuda number of matching tokens of shape (batch_size,)
     """
-    with torch.no_grad():
-        context_tokens = torch.tensor(context_tokens).to('cuda')
-        true_continuation = torch.tensor(true_continuation).to('cuda')
+    with torch.inference_mode():
+        context_len = context_tokens.shape[1]
+
+        # Greedy decoding. As `generate(min_length = 64)` did, never pick the eos token
+        eos_token_id = model.config.eos_token_id
+        def next_tokens(logits):
+            logits = logits[:, -1]
+            logits[:, eos_token_id] = -float('inf')
+            return logits.argmax(dim = -1)
+
+        # Prefill runs the base model and projects only the last position onto the
+        # vocabulary, instead of materializing logits for the whole context
+        def prefill(tokens, **kwargs):
+            outputs = model.gpt_neox(tokens, **kwargs)
+            return model.embed_out(outputs.last_hidden_state[:, -1:]), outputs
+
+        if cache is not None:
+            batch_size = context_tokens.shape[0]
+            context_tokens = torch.nn.functional.pad(
+                context_tokens, (0, 0, 0, cache.max_batch_size - batch_size))
+            # Positions are created on the gpu once, instead of a host to device copy per step
+            positions = torch.arange(context_len + true_continuation.shape[1] - 1, device = 'cuda')
 
-        generations = model.generate(context_tokens, temperature = 0.0, top_k = 0, top_p = 0, max_length = 64, min_length = 64)
+            # Reuse the static cache instead of reallocating it, prefill runs eagerly
+            cache.reset()
+            logits, _ = prefill(
+                context_tokens,
+                past_key_values = cache,
+                cache_position = positions[:context_len],
+                use_cache = True
+            )
+            generations = [next_tokens(logits)]
+            for step in range(context_len, positions.shape[0]):
+                outputs = decode_step(
+                    generations[-1].unsqueeze(-1),
+                    past_key_values = cache,
+                    cache_position = positions[step:step + 1],
+                    use_cache = True
+                )
+                generations.append(next_tokens(outputs.logits))
+            generations = [tokens[:batch_size] for tokens in generations]
+        else:
+            logits, outputs = prefill(context_tokens, use_cache = True)
+            generations = [next_tokens(logits)]
+            for _ in range(true_continuation.shape[1] - 1):
+                outputs = model(
+                    generations[-1].unsqueeze(-1),
+                    past_key_values = outputs.past_key_values,
+                    use_cache = True
+                )
+                generations.append(next_tokens(outputs.logits))
+        generations = torch.stack(generations, dim = 1)
 
+        # Integer counts, the division happens on the host when writing the evals
+        return (true_continuation == generations).sum(dim = -1)
 
-        accuracies = (true_continuation == generations[:,32:64]).float().mean(axis=-1)
-        return accuracies.cpu()
+def score_teacher_forced(model, context_tokens, true_continuation):
+    """Calculate teacher forced memorization score from context tokens and true continuation
+
+    Runs a single forward pass over context and true continuation, and counts the positions
+    where the greedy next token given the true prefix is the true continuation token. A
+    sequence scores 32 here exactly if greedy generation reproduces the whole continuation,
+    but partial scores can be higher than `score`'s, as generation is never knocked off
+    the true continuation by an earlier mismatch.
+
+    Args:
+        model (transformers.GPTNeoXForCausalLM): Pythia model instance being evaluated
+        context_tokens (torch.Tensor): Cuda context token indicies of shape (batch_size, 32)
+        true_continuation (torch.Tensor): Cuda true continuation indicies of shape (batch_size, 32)
+
+    Returns:
+        num_correct (torch.Tensor): Cuda number of matching tokens of shape (batch_size,)
+    """
+    with torch.inference_mode():
+        context_len = context_tokens.shape[1]
+        # The last true continuation token is never needed as input
+        tokens = torch.cat([context_tokens, true_continuation[:, :-1]], dim = 1)
+        # Only the positions predicting the continuation are projected onto the vocabulary
+        hidden = model.gpt_neox(tokens, use_cache = False).last_hidden_state
+        logits = model.embed_out(hidden[:, context_len - 1:])
+        logits[..., model.config.eos_token_id] = -float('inf')
+        return (true_continuation == logits.argmax(dim = -1)).sum(dim = -1)
+
+def collect_evals(pending, num_correct, start_idx):
+    """Copies scores of several batches to the host, into their place in `num_correct`
+
+    All scores are concatenated on the gpu and copied with a single `.cpu()`, so
+    there is only one sync for all of `pending`
+
+    Args:
+        pending (list): `(start index of batch, cuda number of matching tokens)` of scored batches
+        num_correct (np.ndarray): Number of matching tokens of every sequence of the current rank
+        start_idx (int): Sequence index of first sequence evaluated by current rank
+    """
+    scores = torch.cat([acc for _, acc in pending]).cpu().numpy()
+    offset = 0
+    for idx, acc in pending:
+        num_correct[idx - start_idx:idx - start_idx + len(acc)] = scores[offset:offset + len(acc)]
+        offset += len(acc)
+
+def launch_id():
+    """Returns an identifier shared by all ranks of a launch, that differs between launches
+
+    `RUN_ID` if set. Under slurm, the job id, restart count and step id, as requeued jobs
+    keep their job id and every `srun` is a new step. Under torchrun, its rendezvous id,
+    which `--standalone` sets to a random uuid.
+
+    Raises:
+        ValueError: If no launch unique identifier is available
+    """
+    if 'RUN_ID' in os.environ:
+        return os.environ['RUN_ID']
+    if 'SLURM_JOB_ID' in os.environ:
+        return '_'.join(os.environ.get(var, '0')
+            for var in ('SLURM_JOB_ID', 'SLURM_RESTART_COUNT', 'SLURM_STEP_ID'))
+    if os.environ.get('TORCHELASTIC_RUN_ID', 'none') != 'none':
+        return f"{os.environ['TORCHELASTIC_RUN_ID']}_{os.environ.get('TORCHELASTIC_RESTART_COUNT', '0')}"
+    raise ValueError("Set RUN_ID to a value shared by all ranks and unique to this launch")
+
+def fs_barrier(barrier_dir, name, rank, num_procs, poll_interval = 5, timeout = 3*60*60, wait = True):
+    """Blocks until all ranks reached the barrier `name`
+
+    Filesystem replacement of `torch.distributed.barrier`, so no process group has to be
+    initialized. Every rank touches `{barrier_dir}/{name}/rank-{rank}.done`. Only rank 0
+    lists the directory, until the files of all ranks exist, and then touches `release`.
+    The other ranks only check for `release`, so the shared filesystem isn't flooded
+    with directory listings. Other files in the directory are ignored.
+
+    Args:
+        barrier_dir (str): Directory unique to the current launch, on a filesystem shared by all nodes
+        name (str): Name of the barrier, unique within the launch
+        rank (int): Rank of current process
+        num_procs (int): Number of ranks to wait for
+        poll_interval (float): Seconds between checks for the other ranks' files
+        timeout (float): Seconds to wait before giving up on the other ranks
+        wait (bool): If false, ranks other than 0 only mark themselves as arrived,
+            without waiting for the release
+
+    Raises:
+        RuntimeError: If the barrier isn't released within `timeout` seconds
+    """
+    path = os.path.join(barrier_dir, name)
+    release = os.path.join(path, 'release')
+    os.makedirs(path, exist_ok = True)
+    open(os.path.join(path, f'rank-{rank}.done'), 'w').close()
+
+    deadline = time.time() + timeout
+    def released():
+        if rank != 0:
+            return os.path.exists(release)
+        missing = {f'rank-{r}.done' for r in range(num_procs)}.difference(os.listdir(path))
+        if missing:
+            return False
+        open(release, 'w').close()
+        return True
+
+    while (rank == 0 or wait) and not released():
+        if time.time() > deadline:
+            raise RuntimeError(f"Barrier {name} not released after {timeout}s")
+        time.sleep(poll_interval)
 
 def main():
     # Extracting environment variables and miscellaneous initializations
@@ -131,24 +388,19 @@ def main():
     # Eval configuration variables
     MODEL = os.environ['MODEL']
     CHECKPOINT = int(os.environ['CHECKPOINT'])
+    # Score with one teacher forced forward pass instead of greedy generation,
+    # see `score_teacher_forced` for how partial scores differ
+    TEACHER_FORCING = os.environ.get('TEACHER_FORCING', '0') == '1'
 
-    # Distributed initializations
-    # os.environ['MASTER_ADDR'] = os.environ['SLURM_LAUNCH_NODE_IPADDR']
-    # os.environ['MASTER_PORT'] = '12128'
+    # Distributed initializations. Ranks never communicate, they only wait for each
+    # other through files in BARRIER_DIR, so no process group is initialized
+    BARRIER_DIR = os.path.join(
+        os.environ.get('BARRIER_DIR', '/fsx/orz/runs'),
+        f'memorization_{MODEL}_{CHECKPOINT}_{launch_id()}'
+    )
     logging.basicConfig(format = f'rank-{RANK}:' + '%(levelname)s:%(message)s', level = logging.INFO)
-    logging.info(f"Initializing torch distributed with gpus {torch.cuda.device_count()}")
-
-    # Initialize torch distributed
+    logging.info(f"Initializing with gpus {torch.cuda.device_count()}")
     torch.cuda.set_device(RANK)
-    dist.init_process_group(
-        "nccl",
-        world_size = NUM_PROCS,
-        rank = RANK
-    )
-    store = dist.TCPStore(os.environ['MASTER_ADDR'], port = 12125, 
-        world_size = NUM_PROCS, is_master = RANK == 0, timeout = datetime.timedelta(hours=3))
-
-    dist.barrier()
 
     # Model initialization
     transformer_utils.logging.set_verbosity_error()
@@ -161,57 +413,131 @@ def main():
     if RANK == (NUM_PROCS -1):
         end_idx = total_num_sequences - 1
 
-    # Dataset Initialization
+    # Dataset Initialization. The rank's sequences are split in batch aligned halves
+    # between `NUM_PRODUCERS` processes, each prefetching into its own `PREFETCH_MAX`
+    # shared memory slots. Only slot indices go through the shared mp_queue
+    PREFETCH_MAX = 128
+    NUM_PRODUCERS = 2
+    token_slots = torch.empty((NUM_PRODUCERS, PREFETCH_MAX, BATCH_SIZE, 64), dtype = torch.long).share_memory_()
+    free_slots = [mp.Semaphore(PREFETCH_MAX) for _ in range(NUM_PRODUCERS)]
     mp_queue = mp.Queue()
-    ds_process = mp.Process(target = generate_dataset, args=(BATCH_SIZE, start_idx, end_idx, mp_queue))
-    ds_process.start()
+    num_batches = -(-(end_idx - start_idx + 1)//BATCH_SIZE)
+    batches_per_producer = -(-num_batches//NUM_PRODUCERS)
+    ds_processes = []
+    for producer in range(NUM_PRODUCERS):
+        producer_start_idx = start_idx + producer*batches_per_producer*BATCH_SIZE
+        producer_end_idx = min(producer_start_idx + batches_per_producer*BATCH_SIZE - 1, end_idx)
+        # Daemonic, so a rank that fails (e.g. at a barrier timeout) doesn't wait on its producers
+        ds_process = mp.Process(target = generate_dataset, daemon = True, args=(
+            BATCH_SIZE, producer_start_idx, producer_end_idx, mp_queue,
+            token_slots[producer], free_slots[producer], producer))
+        ds_process.start()
+        ds_processes.append(ds_process)
 
     # Model initialization
     model = GPTNeoXForCausalLM.from_pretrained(
         f"EleutherAI/pythia-{MODEL}",
-        use_cache=False,
+        use_cache=True,
+        attn_implementation="sdpa",
+        torch_dtype=torch.bfloat16,
         revision = f'step{CHECKPOINT}',
         cache_dir=f"/fsx/orz/models/"
-    ).half().eval().cuda()
+    ).eval().cuda()
     
-    dist.barrier()
+    # Preallocated kv cache for full batches and a compiled single token forward
+    # pass. Warm up with a dummy batch, so that inductor codegen and cuda graph
+    # capture happen before the eval loop
+    if not TEACHER_FORCING:
+        cache = StaticCache(
+            config = model.config,
+            max_batch_size = BATCH_SIZE,
+            max_cache_len = 64,
+            device = 'cuda',
+            dtype = model.dtype
+        )
+        decode_step = torch.compile(model, mode = "reduce-overhead", fullgraph = True)
+        dummy_batch = torch.zeros((BATCH_SIZE, 32), dtype = torch.long, device = 'cuda')
+        score(model, dummy_batch, dummy_batch, decode_step, cache)
+
+    fs_barrier(BARRIER_DIR, 'loaded', RANK, NUM_PROCS)
     logging.info("Loaded Model")
 
     # Run generations
-    memorization_evals = []
+    copy_stream = torch.cuda.Stream()
+    staging = deque(
+        (torch.empty((BATCH_SIZE, 64), dtype = torch.long).pin_memory(), torch.cuda.Event())
+        for _ in range(2)
+    )
+    num_correct = np.empty(end_idx - start_idx + 1, dtype = np.int64)
+    pending = []
     iters = 0
+    num_running = NUM_PRODUCERS
+    t = time.time()
+    batch = fetch_batch(mp_queue, token_slots, free_slots, copy_stream, staging)
     while(True):
         try:
-            t = time.time()
-            idx, context, true_continuation = mp_queue.get()
+            idx, context, true_continuation = batch
             if idx is None:
-                mp_queue.close()
-                break
-
-            idx = idx
-            logging.info(f"Loading data took {time.time() - t:.3}s")
-            t = time.time()
-            accuracies = score(model, context, true_continuation)
-
-            for acc in accuracies:
-                memorization_evals.append(f'{idx},{acc}')
-                idx += 1
-            logging.info(f"Generation uptil {idx} took {time.time() - t:.3}s")
-            dist.barrier()
+                # Batches of the other producers can still be queued
+                num_running -= 1
+                if num_running == 0:
+                    mp_queue.close()
+                    break
+                batch = fetch_batch(mp_queue, token_slots, free_slots, copy_stream, staging)
+                continue
+
+            # Wait for this batch's copy, then start copying the next batch while
+            # this one is being scored
+            compute_stream = torch.cuda.current_stream()
+            compute_stream.wait_stream(copy_stream)
+            # context and true continuation are views of the same gpu tensor
+            context.record_stream(compute_stream)
+            batch = fetch_batch(mp_queue, token_slots, free_slots, copy_stream, staging)
+
+            # Scores stay on the gpu, they are only synced every LOG_INTERVAL batches
+            if TEACHER_FORCING:
+                accuracies = score_teacher_forced(model, context, true_continuation)
+            else:
+                accuracies = score(model, context, true_continuation, decode_step, cache)
+            pending.append((idx, accuracies))
             iters += 1
+            if iters % LOG_INTERVAL == 0:
+                collect_evals(pending, num_correct, start_idx)
+                pending = []
+                logging.info(f"Generated {iters} batches, last {LOG_INTERVAL} took {time.time() - t:.3}s")
+                t = time.time()
         except StopIteration:
             break
     
-    ds_process.join()
+    if pending:
+        collect_evals(pending, num_correct, start_idx)
+    for ds_process in ds_processes:
+        ds_process.join()
     
-    # Uploading evals to s3
+    # Formatting all evals as `index,accuracy` csv lines at once, gzipped as they are written
+    memorization_evals = io.BytesIO()
+    with gzip.GzipFile(fileobj = memorization_evals, mode = 'wb') as evals_gz:
+        np.savetxt(
+            evals_gz,
+            np.c_[np.arange(start_idx, end_idx + 1), num_correct/32],
+            fmt = '%d,%.5f'
+        )
+
+    # Uploading gzipped evals to s3, upload_fileobj switches to multipart uploads for large files
     s3 = boto3.client('s3')
-    s3.put_object(
-        Body = '\n'.join(memorization_evals).encode(),
-        Bucket = os.environ['Bucket'],
-        Key = f'memorization-evals/evals-running/memorization_{MODEL}_{CHECKPOINT}/rank-{RANK}.csv'
+    memorization_evals.seek(0)
+    s3.upload_fileobj(
+        memorization_evals,
+        os.environ['Bucket'],
+        f'memorization-evals/evals-running/memorization_{MODEL}_{CHECKPOINT}/rank-{RANK}.csv.gz',
+        ExtraArgs = {'ContentEncoding': 'gzip'}
     )
-    dist.barrier()
+    fs_barrier(BARRIER_DIR, 'uploaded', RANK, NUM_PROCS)
+
+    # Rank 0 removes the barrier files, once every rank is past the last barrier
+    fs_barrier(BARRIER_DIR, 'exited', RANK, NUM_PROCS, wait = False)
+    if RANK == 0:
+        shutil.rmtree(BARRIER_DIR)
 
     return
 if __name__ == '__main__':